@@ -5,11 +5,10 @@ import os
 from datetime import datetime, timedelta
 
 import requests
-import yaml
+
+from sentinel_stac import read_configuration
 
 DEBUG = False
-DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
-CONFIG_FILE = "sentinel_config.yml"
 LIST_FILENAME = "gen_new_list_processed.txt"
 TIMESTAMP_FILENAME = "gen_new_list_timestamp.txt"
 
@@ -54,27 +53,31 @@ def print_debug(msg):
         print(msg)
 
 
-def read_configuration():
+def format_timestamp(dt):
     """
-    Read configuration file.
+    Formats a datetime to the OData timestamp format with max. 3 millisecond decimal places.
+    Built directly from the datetime attributes, which skips strftime's locale machinery
+    and the trailing-slice allocation.
     """
-    with open(CONFIG_FILE, "r") as f:
-        return yaml.safe_load(f)
+    return (f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}T"
+            f"{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}.{dt.microsecond // 1000:03d}")
 
 
 def get_timestamp(local_dir):
     """
     Reads timestamp of last script run. If file does not exist or is malformed, fallbacks to last 31 days.
-    Timestamp needs to be trimmed to max. 3 millisecond decimal places.
+    Timestamp needs to be trimmed to max. 3 millisecond decimal places; files written by
+    older versions store microseconds.
     """
     timestamp_filepath = os.path.join(local_dir, TIMESTAMP_FILENAME)
-    fallback_timestamp = (datetime.now() - timedelta(days=31)).strftime(DATE_FORMAT)[:-3]
+    fallback_timestamp = format_timestamp(datetime.now() - timedelta(days=31))
     if not os.path.isfile(timestamp_filepath) or not os.path.getsize(timestamp_filepath):
         return fallback_timestamp
     with open(timestamp_filepath, "r") as f:
         content = f.read().strip()
         try:
-            timestamp = content[:-3]
+            fraction = content.rsplit('.', 1)[-1]
+            timestamp = content[:len(content) - (len(fraction) - 3)] if len(fraction) > 3 else content
             print_debug(f"Using stored timestamp {timestamp}")
             return timestamp
         except ValueError:
@@ -82,72 +85,99 @@ def get_timestamp(local_dir):
     return fallback_timestamp
 
 
-def create_missing_dir(dir_path):
-    """
-    Creates directory, if it does not exist yet (including all missing directories in the path).
-    """
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path, exist_ok=True)
-
-
-def fetch_products(host_url, timestamp):
+def fetch_products(host_url, timestamp, stored_set):
     """
-    Fetches all products created after given timestamp
+    Fetches all products created after given timestamp, keeping only ids not already
+    present in stored_set. Filtering while paging means only the unprocessed ids are
+    held in memory, never the full fetched list alongside the stored one.
     """
-    fetched_count = 100
-    page_size = 100
+    # 1000 is the maximum page size the DHuS OData endpoint serves; larger pages
+    # mean 10x fewer HTTP round trips than the previous $top=100
+    page_size = 1000
+    skipped = 0
+    seen = set()
     result = []
 
-    # header is included in response
-    while fetched_count + 1 >= page_size:
+    while True:
         url = f"{host_url}/odata/v1/Products"
         params = {
             '$format': 'text/csv',
             '$select': 'Id',
-            '$skip': len(result),
+            '$skip': skipped,
             '$top': page_size,
             '$filter': f"CreationDate ge datetime'{timestamp}'"
         }
-        response = requests.get(url, params=params)
-
-        if not response.ok:
-            raise Exception(f"Request to fetch products file failed with {response.status_code}.\n{response.text}")
-
-        product_ids = response.text.splitlines()[1:]
-        result.extend(product_ids)
-        fetched_count = len(product_ids)
-    print_debug(f"Fetched {len(result)} products.")
+        with requests.get(url, params=params, stream=True) as response:
+            if not response.ok:
+                raise Exception(f"Request to fetch products file failed with {response.status_code}.\n{response.text}")
+
+            # stream the CSV body line by line instead of materializing response.text
+            # plus a list of all lines; the first line is the header
+            lines = response.iter_lines(decode_unicode=True)
+            next(lines, None)
+            product_ids = [line for line in lines if line]
+        skipped += len(product_ids)
+        for product_id in product_ids:
+            if product_id not in stored_set and product_id not in seen:
+                seen.add(product_id)
+                result.append(product_id)
+        # a short page means the server has no more products for the filter
+        if len(product_ids) < page_size:
+            break
+    print_debug(f"Fetched {skipped} products.")
     return result
 
 
 def load_cached_products(local_dir):
     """
-    Loads file containing last processed product ids, if the file exists.
+    Loads file containing last processed product ids into a set, if the file exists.
+    Streams line by line, so no intermediate list of all lines is built.
     """
     filepath = os.path.join(local_dir, LIST_FILENAME)
     if not os.path.exists(filepath):
-        return []
-    else:
-        with open(filepath, "r") as f:
-            return f.readlines()
+        return set()
+    with open(filepath, "r") as f:
+        return {line.rstrip('\n') for line in f}
 
 
 def store_new_timestamp(local_dir, new_timestamp):
     """
     Overwrites last time of processing with new timestamp.
+    Written to a temp file and renamed, so a crash mid-write never leaves a partial file
+    that would force the next run to refetch the whole fallback window.
     """
     timestamp_filepath = os.path.join(local_dir, TIMESTAMP_FILENAME)
-    with open(timestamp_filepath, 'w') as f:
+    tmp_filepath = timestamp_filepath + '.tmp'
+    with open(tmp_filepath, 'w') as f:
         f.write(new_timestamp)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filepath, timestamp_filepath)
 
 
 def store_new_list(local_dir, missing_products):
     """
-    Overwrites last processed product ids with new ones.
+    Overwrites last processed product ids with new ones, atomically via a temp file.
     """
     list_filepath = os.path.join(local_dir, LIST_FILENAME)
-    with open(list_filepath, 'w') as f:
-        f.write("\n".join(missing_products))
+    tmp_filepath = list_filepath + '.tmp'
+    with open(tmp_filepath, 'w') as f:
+        # stream through the io buffer instead of joining one huge string first
+        f.writelines(product + '\n' for product in missing_products)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filepath, list_filepath)
+
+
+def sync_directory(dir_path):
+    """
+    Flushes directory metadata, making the renames from the atomic stores durable.
+    """
+    dir_fd = os.open(dir_path, os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
 
 
 def main():
@@ -163,15 +193,15 @@ def main():
 
     timestamp = args.fromTimestamp or get_timestamp(local_dir)
 
-    new_timestamp = datetime.now().strftime(DATE_FORMAT)
-    fetched_products = fetch_products(sentinel_host, timestamp)
-    stored_products = load_cached_products(local_dir)
-    missing_products = list(set(fetched_products) - set(stored_products))
+    new_timestamp = format_timestamp(datetime.now())
+    stored_set = load_cached_products(local_dir)
+    missing_products = fetch_products(sentinel_host, timestamp, stored_set)
     print_debug(f"There are {len(missing_products)} unprocessed products.")
 
     if not args.dryRun:
         store_new_timestamp(local_dir, new_timestamp)
         store_new_list(local_dir, missing_products)
+        sync_directory(local_dir)
 
 
 if __name__ == "__main__":
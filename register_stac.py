@@ -1,44 +1,64 @@
 #!/usr/bin/python3
 
 import argparse
+import functools
+import itertools
+import json
 import netrc
 import os
 import re
+import shutil
 import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from urllib.parse import urlparse
 
 import defusedxml.ElementTree
-import pystac
 import requests
-import stactools.sentinel1.grd.stac
-import stactools.sentinel1.slc.stac
-import stactools.sentinel2.stac
-import stactools.sentinel3.stac
-from stactools.sentinel3 import constants
-import stactools.sentinel5p.stac
-import yaml
 from requests import Session
-from stactools.sentinel3.file_extension_updated import FileExtensionUpdated
+from requests.adapters import HTTPAdapter, Retry
 from tqdm import tqdm
 
 import sentinel_stac
+from sentinel_stac import create_missing_dir, read_configuration
 
-CONFIG_FILE = "sentinel_config.yml"
 ERR_PREFIX = ""
 SUCC_PREFIX = ""
 PRODUCT_ID = None
 COLLECTION = None
+MAX_WORKERS = 8
 
-# Stactools fixes
-# Our S3 data don't contain reducedMeasurementData
-stactools.sentinel3.constants.SRAL_L2_LAN_WAT_KEYS.remove("reducedMeasurementData")
+# shared session, so metadata fetches reuse pooled keep-alive connections instead of
+# opening a new TCP+TLS connection per file; transient failures are retried with backoff
+_ADAPTER = HTTPAdapter(pool_connections=32,
+                       pool_maxsize=32,
+                       max_retries=Retry(total=3, backoff_factor=0.3))
+SESSION = requests.Session()
+SESSION.mount("https://", _ADAPTER)
+SESSION.mount("http://", _ADAPTER)
 
-# Monkey-patch class method of Sentinel3 module to avoid casting error
-def new_ext(cls, obj: pystac.Asset, add_if_missing: bool = False):
-    return super(FileExtensionUpdated, cls).ext(obj, add_if_missing)
-FileExtensionUpdated.ext = classmethod(new_ext)
+
+def load_sentinel3_stac():
+    """
+    Imports the stactools Sentinel 3 module and applies our fixes to it on first use.
+    The stactools imports are deferred to the platform branches in main(), since each
+    of them pulls in heavy dependencies while a single run only needs one platform.
+    """
+    import stactools.sentinel3.stac
+    from stactools.sentinel3 import constants
+    from stactools.sentinel3.file_extension_updated import FileExtensionUpdated
+
+    # Stactools fixes
+    # Our S3 data don't contain reducedMeasurementData
+    if "reducedMeasurementData" in constants.SRAL_L2_LAN_WAT_KEYS:
+        constants.SRAL_L2_LAN_WAT_KEYS.remove("reducedMeasurementData")
+
+    # Monkey-patch class method of Sentinel3 module to avoid casting error
+    def new_ext(cls, obj, add_if_missing: bool = False):
+        return super(FileExtensionUpdated, cls).ext(obj, add_if_missing)
+    FileExtensionUpdated.ext = classmethod(new_ext)
+    return stactools.sentinel3.stac
 
 
 def parse_arguments():
@@ -92,60 +112,88 @@ def parse_arguments():
     return args
 
 
+@functools.lru_cache(maxsize=None)
+def get_logfile(prefix):
+    """
+    Lazily opens the dated log file for the given prefix and keeps the handle open
+    for the process lifetime. Line-buffered, so every record is flushed on write.
+    """
+    path = prefix + datetime.now().strftime('%Y-%m-%d')
+    create_missing_dir(os.path.dirname(path))
+    return open(path, 'a', buffering=1)
+
+
 def die_with_error(msg, detailed_msg="", code=-1):
     """
     Before terminating with exception, writes message to error file.
     Known HTTP error code should be used, otherwise -1 is used.
     """
-    rundate = datetime.now().strftime('%Y-%m-%d')
-    err_file = ERR_PREFIX + rundate
-    create_missing_dir(os.path.dirname(err_file))
-    with open(err_file, 'a') as f:
-        f.write(f"{COLLECTION},{PRODUCT_ID},{code}:{msg}\n")
+    get_logfile(ERR_PREFIX).write(f"{COLLECTION},{PRODUCT_ID},{code}:{msg}\n")
     raise Exception("\n".join([f"{code}: {msg}", detailed_msg]))
 
 
-def read_configuration():
+def fetch_file(url, output_path, session=None):
+    """
+    Downloads a file from a URL and saves it to the specified output path, without progress reporting.
+    Used by the parallel fetchers, where per-file progress bars would interleave.
+    """
+    # if ~/.netrc file is found, it is used automatically as a basic auth for all requests
+    response = (session or SESSION).get(url, stream=True)
+    if not response.ok:
+        die_with_error(f"Request to fetch file {url} failed.", response.text, response.status_code)
+    with open(output_path, "wb") as f:
+        for data in response.iter_content(256 * 1024):
+            f.write(data)
+
+
+# prebound formatter, so building a Nodes URL maps segments through one C-level call
+# instead of evaluating an f-string per segment
+_NODE_SEGMENT = "/Nodes('{}')".format
+
+
+def odata_nodes_url(product_url, rel_path):
     """
-    Read configuration file.
+    Builds the OData /Nodes URL for a path relative to the product root.
     """
-    with open(CONFIG_FILE, "r") as f:
-        return yaml.safe_load(f)
+    return product_url + ''.join(map(_NODE_SEGMENT, rel_path.split('/'))) + "/$value"
 
 
-def create_missing_dir(dir_path):
+def fetch_files_parallel(downloads, desc):
     """
-    Creates directory, if it does not exist yet (including all missing directories in the path).
+    Downloads (url, output_path) pairs concurrently over the shared session,
+    reporting progress per finished file in a single aggregate bar.
     """
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(fetch_file, url, output_path) for url, output_path in downloads]
+        for future in tqdm(as_completed(futures),
+                           total=len(futures),
+                           desc=desc,
+                           leave=True,
+                           file=sys.stdout):
+            future.result()
 
 
-def request_with_progress(url, output_path):
+def request_with_progress(url, output_path, session=None):
     """
     Downloads a file from a URL and saves it to the specified output path, with a progress bar.
     """
     # if ~/.netrc file is found, it is used automatically as a basic auth for all requests
-    response = requests.get(url, stream=True)
+    response = (session or SESSION).get(url, stream=True)
     total_size = int(response.headers.get('content-length', 0))  # Total size in bytes
-    block_size = 1024  # Size of each block (1 KB)
+    block_size = 256 * 1024  # Size of each block (256 KB)
 
     if not response.ok:
         die_with_error(f"Request to fetch file {url} failed.", response.text, response.status_code)
 
-    progress_bar = tqdm(total=total_size,
-                        unit='iB',
-                        unit_scale=True,
-                        desc=f"Fetching file {output_path.split('/')[-1]}",
-                        leave=True,
-                        file=sys.stdout)
-
-    with open(output_path, "wb") as f:
-        for data in response.iter_content(block_size):
-            progress_bar.update(len(data))
-            f.write(data)
-
-    progress_bar.close()
+    response.raw.decode_content = True
+    with open(output_path, "wb") as f, tqdm.wrapattr(f, 'write',
+                                                     total=total_size,
+                                                     unit='iB',
+                                                     unit_scale=True,
+                                                     desc=f"Fetching file {output_path.split('/')[-1]}",
+                                                     leave=True,
+                                                     file=sys.stdout) as wrapped_file:
+        shutil.copyfileobj(response.raw, wrapped_file, length=block_size)
 
 
 def fetch_product_data(sentinel_host, metadata_dir):
@@ -155,16 +203,26 @@ def fetch_product_data(sentinel_host, metadata_dir):
     url = f"{sentinel_host}/odata/v1/Products('{PRODUCT_ID}')/Nodes"
     output_path = os.path.join(metadata_dir, "node.xml")
     request_with_progress(url, output_path)
-    with open(output_path, "rb") as f:
-        metadata = f.read()
-        data = defusedxml.ElementTree.fromstring(metadata)
-    namespaces = {'atom': 'http://www.w3.org/2005/Atom'}
-
-    entry_node = data.find('atom:entry', namespaces)
-    title_node = entry_node.find('atom:title', namespaces) if entry_node is not None else None
-    title = title_node.text if title_node is not None else None
-    product_node = entry_node.find('atom:id', namespaces) if entry_node is not None else None
-    product_url = product_node.text if product_node is not None else None
+
+    # parse incrementally instead of buffering the whole feed in memory; only the
+    # title and id of the first atom entry are needed (the feed element carries its
+    # own title/id, hence the in_entry guard)
+    atom_ns = '{http://www.w3.org/2005/Atom}'
+    title = None
+    product_url = None
+    in_entry = False
+    for event, element in defusedxml.ElementTree.iterparse(output_path, events=("start", "end")):
+        if event == "start":
+            if element.tag == atom_ns + 'entry':
+                in_entry = True
+        elif in_entry:
+            if element.tag == atom_ns + 'title':
+                title = element.text
+            elif element.tag == atom_ns + 'id':
+                product_url = element.text
+            elif element.tag == atom_ns + 'entry':
+                break
+            element.clear()
     platform = title[0:2] if title else None
     global COLLECTION
     COLLECTION = map_to_collection(title)
@@ -180,6 +238,14 @@ def fetch_product_data(sentinel_host, metadata_dir):
     return title, product_url, platform
 
 
+@functools.lru_cache(maxsize=1)
+def get_netrc():
+    """
+    Parses the ~/.netrc file once per process; batch drivers check hosts per product.
+    """
+    return netrc.netrc()
+
+
 def check_hosts(sentinel_host, stac_host, push):
     """
     Checks sentinel_host and stac_host variables were resolved and .netrc file contains authentication credentials.
@@ -189,13 +255,15 @@ def check_hosts(sentinel_host, stac_host, push):
     if not stac_host and push:
         die_with_error("STAC host not configured properly!")
 
+    sentinel_netloc = urlparse(sentinel_host).netloc
+    stac_netloc = urlparse(stac_host).netloc if push else None
     try:
-        auth_info = netrc.netrc()
-        if not auth_info.authenticators(urlparse(sentinel_host).netloc):
+        auth_info = get_netrc()
+        if not auth_info.authenticators(sentinel_netloc):
             die_with_error(
-                f"Host {urlparse(sentinel_host)} not found in authentication credentials in the .netrc file!")
-        if push and not auth_info.authenticators(urlparse(stac_host).netloc):
-            die_with_error(f"Host {urlparse(stac_host)} not found in authentication credentials in the .netrc file!")
+                f"Host {sentinel_netloc} not found in authentication credentials in the .netrc file!")
+        if push and not auth_info.authenticators(stac_netloc):
+            die_with_error(f"Host {stac_netloc} not found in authentication credentials in the .netrc file!")
     except (FileNotFoundError, netrc.NetrcParseError) as e:
         die_with_error(f"Error parsing authentication file .netrc in the home directory.")
 
@@ -204,9 +272,9 @@ def map_to_collection(product_name):
     """
     Returns the normalized collection name for a given product.
     """
-    for pattern, collection in sentinel_stac.product_collection_mapping.items():
-        if re.match(pattern, product_name):
-            return collection
+    collection = sentinel_stac.map_to_collection(product_name)
+    if collection:
+        return collection
     die_with_error("Could not match product to collection name! Probably missing in the sentinel_stac.py mappings.")
 
 
@@ -214,20 +282,12 @@ def fetch_platform_metadata(product_url, metadata_dir, platform):
     """
     Fetches metadata from product's /Nodes data and stores them in the metadata directory.
     """
-    if platform.lower() == "s1":
-        platform_files = sentinel_stac.s1_files
-    elif platform.lower() == "s2":
-        platform_files = sentinel_stac.s2_files
-    elif platform.lower() == "s3":
-        platform_files = sentinel_stac.s3_files
-    elif platform.lower() == "s5":
-        platform_files = sentinel_stac.s5_files
-    else:
+    platform_files = sentinel_stac.platform_files.get(platform.lower())
+    if platform_files is None:
         die_with_error(f"Platform {platform} not supported!")
-    for file in platform_files:
-        source_url = f"{product_url}/Nodes('{file}')/$value"
-        output_file = os.path.join(metadata_dir, file)
-        request_with_progress(source_url, output_file)
+    downloads = [(f"{product_url}/Nodes('{file}')/$value", os.path.join(metadata_dir, file))
+                 for file in platform_files]
+    fetch_files_parallel(downloads, desc="Fetching platform metadata")
 
 
 def fetch_nested_s1_files(metadata, product_url, metadata_dir):
@@ -235,13 +295,14 @@ def fetch_nested_s1_files(metadata, product_url, metadata_dir):
     From the processed metadata file downloads the missing metadata files, which we know
     the stactools will be working with.
     """
-    filepaths = metadata.annotation_hrefs + metadata.noise_hrefs + metadata.calibration_hrefs
+    filepaths = itertools.chain(metadata.annotation_hrefs, metadata.noise_hrefs, metadata.calibration_hrefs)
+    prefix_length = len(metadata_dir) + 1  # account for the trailing slash
+    downloads = []
     for ref_name, filepath in filepaths:
-        url_path_extension = filepath.split(f"{metadata_dir}{'/'}")[1]
-        url_path_segments = url_path_extension.split('/')
-        nested_file_url = product_url + ''.join(f"/Nodes('{segment}')" for segment in url_path_segments) + "/$value"
+        nested_file_url = odata_nodes_url(product_url, filepath[prefix_length:])
         create_missing_dir(os.path.dirname(filepath))
-        request_with_progress(nested_file_url, filepath)
+        downloads.append((nested_file_url, filepath))
+    fetch_files_parallel(downloads, desc="Fetching nested metadata")
 
 
 def fetch_nested_s2_files(metadata, product_url, metadata_dir):
@@ -254,12 +315,13 @@ def fetch_nested_s2_files(metadata, product_url, metadata_dir):
                  metadata.inspire_metadata_href,
                  metadata.datastrip_metadata_href,
                  ]
+    prefix_length = len(metadata_dir) + 1  # account for the trailing slash
+    downloads = []
     for filepath in filepaths:
-        url_path_extension = filepath.split(f"{metadata_dir}{'/'}")[1]
-        url_path_segments = url_path_extension.split('/')
-        nested_file_url = product_url + ''.join(f"/Nodes('{segment}')" for segment in url_path_segments) + "/$value"
+        nested_file_url = odata_nodes_url(product_url, filepath[prefix_length:])
         create_missing_dir(os.path.dirname(filepath))
-        request_with_progress(nested_file_url, filepath)
+        downloads.append((nested_file_url, filepath))
+    fetch_files_parallel(downloads, desc="Fetching nested metadata")
 
 
 def fetch_s5_metadata(product_url, title, metadata_dir):
@@ -272,34 +334,28 @@ def fetch_s5_metadata(product_url, title, metadata_dir):
     request_with_progress(url, output_file)
 
 
-def regenerate_href_links(stacfile_path, metadata_dir, product_url, salt):
+def rewrite_hrefs(text, metadata_dir, product_url, salt):
     """
-    Replaces href links in the final json containing the local path to contain the OData path and format.
+    Replaces href links in the STAC json text containing the local path to contain the OData path and format.
     Cannot use stactools' create_item function parameters for this change, as the stac module is then actually reading
     from the hrefs, or the change does not affect all the hrefs.
     """
-    print("Regenerating href links")
-    new_file = stacfile_path.split('/')
-    new_file[-1] = 'new_' + new_file[-1]
-    new_file = os.path.join('/', *new_file)
-    with (open(stacfile_path, 'r') as infile, open(new_file, 'w') as outfile):
-        for line in infile:
-            if metadata_dir in line:
-                # replace file links
-                split_line = line.split('"')  # [' ', 'href', ': ', 'matadata_dir/resource/path', '\n']
-                url_path_segments = split_line[-2].split(f"{metadata_dir}{'/'}")[1].split("/")
-                correct_link = product_url + ''.join(
-                    f"/Nodes('{segment}')" for segment in url_path_segments) + "/$value"
-                split_line[-2] = correct_link
-                outfile.write('"'.join(split_line))
-            elif '"id":' in line and salt:
-                # prefix title, so unique UUID is generated if same product comes from different sources
-                split_line = line.split('": "')
-                salted_line = split_line[0] + '": "' + salt + split_line[1]
-                outfile.write(salted_line)
-            else:
-                outfile.write(line)
-    os.replace(new_file, stacfile_path)
+    pattern = re.compile(r'"(' + re.escape(metadata_dir) + r'/[^"]+)"')
+    link_cache = {}
+
+    prefix_length = len(metadata_dir) + 1  # account for the trailing slash
+
+    def replace_link(match):
+        local_path = match.group(1)
+        if local_path not in link_cache:
+            link_cache[local_path] = odata_nodes_url(product_url, local_path[prefix_length:])
+        return '"' + link_cache[local_path] + '"'
+
+    text = pattern.sub(replace_link, text)
+    if salt:
+        # prefix title, so unique UUID is generated if same product comes from different sources
+        text = text.replace('"id": "', '"id": "' + salt)
+    return text
 
 
 def get_auth_token(token_url):
@@ -319,6 +375,9 @@ def get_auth_session(token):
     token_session = Session()
     token_session.trust_env = False  # need to overwrite the authorization header, otherwise BA is used
     token_session.headers.update({"Authorization": f"Bearer {token}"})
+    # reuse the shared pooled adapter, so uploads get keep-alive and retries too
+    token_session.mount("https://", _ADAPTER)
+    token_session.mount("http://", _ADAPTER)
     return token_session
 
 
@@ -349,22 +408,15 @@ def upload_to_catalogue(stac_host, stac_filepath, overwrite=False):
 
     with open(stac_filepath, 'r') as file:
         json_data = file.read()
-        rundate = datetime.now().strftime('%Y-%m-%d')
         token_session = get_auth_session(token)
         response = token_session.post(url, data=json_data)
 
         if response.ok:
-            succ_file = SUCC_PREFIX + rundate
-            create_missing_dir(os.path.dirname(succ_file))
-            with open(succ_file, 'a') as f:
-                f.write(f"{COLLECTION},{PRODUCT_ID}\n")
+            get_logfile(SUCC_PREFIX).write(f"{COLLECTION},{PRODUCT_ID}\n")
         elif response.status_code == 409:
             if not overwrite:
                 # don't die
-                err_file = ERR_PREFIX + rundate
-                create_missing_dir(os.path.dirname(err_file))
-                with open(err_file, 'a') as f:
-                    f.write(f"{COLLECTION},{PRODUCT_ID},0,Skipped existing product\n")
+                get_logfile(ERR_PREFIX).write(f"{COLLECTION},{PRODUCT_ID},0,Skipped existing product\n")
                 print("Product already registered, skipping.")
             else:
                 if response.text and "Feature" in response.text and "ErrorMessage" in response.text:
@@ -414,6 +466,7 @@ def main():
         print(f"Created temporary directory: {metadata_dir}")
 
         title, product_url, platform = fetch_product_data(sentinel_host, metadata_dir)
+        platform_key = platform.lower()
 
         metadata_dir = os.path.join(metadata_dir, title)
         os.mkdir(metadata_dir)
@@ -421,23 +474,28 @@ def main():
         fetch_platform_metadata(product_url, metadata_dir, platform)
 
         try:
-            if platform.lower() == "s1":
+            if platform_key == "s1":
                 product_type = title.split("_")[2]
                 if product_type.lower() == "slc":
+                    import stactools.sentinel1.slc.stac
                     metadata = stactools.sentinel1.slc.stac.SLCMetadataLinks(metadata_dir)
                     fetch_nested_s1_files(metadata, product_url, metadata_dir)
                     item = stactools.sentinel1.slc.stac.create_item(granule_href=metadata_dir)
                 else:
+                    import stactools.sentinel1.grd.stac
                     metadata = stactools.sentinel1.grd.stac.MetadataLinks(metadata_dir)
                     fetch_nested_s1_files(metadata, product_url, metadata_dir)
                     item = stactools.sentinel1.grd.stac.create_item(granule_href=metadata_dir)
-            elif platform.lower() == "s2":
+            elif platform_key == "s2":
+                import stactools.sentinel2.stac
                 safe_manifest = stactools.sentinel2.stac.SafeManifest(metadata_dir)
                 fetch_nested_s2_files(safe_manifest, product_url, metadata_dir)
                 item = stactools.sentinel2.stac.create_item(granule_href=metadata_dir)
-            elif platform.lower() == "s3":
-                item = stactools.sentinel3.stac.create_item(granule_href=metadata_dir, skip_nc=True)
-            elif platform.lower() == "s5":
+            elif platform_key == "s3":
+                sentinel3_stac = load_sentinel3_stac()
+                item = sentinel3_stac.create_item(granule_href=metadata_dir, skip_nc=True)
+            elif platform_key == "s5":
+                import stactools.sentinel5p.stac
                 fetch_s5_metadata(product_url, title, metadata_dir)
                 item = stactools.sentinel5p.stac.create_item(os.path.join(metadata_dir, title))
             else:
@@ -449,9 +507,12 @@ def main():
         stac_filepath = os.path.join(stac_storage, "{}.json".format(item.id))
 
         print(f"Writing metadata to file: {stac_filepath}")
-        item.save_object(dest_href=stac_filepath, include_self_link=False)
-
-        regenerate_href_links(stac_filepath, metadata_dir, product_url, salt)
+        # serialize once, rewrite the hrefs in memory and write a single file, instead
+        # of save_object followed by a read-rewrite-write pass over the same file
+        stac_json = json.dumps(item.to_dict(include_self_link=False), indent=2)
+        stac_json = rewrite_hrefs(stac_json, metadata_dir, product_url, salt)
+        with open(stac_filepath, 'w') as f:
+            f.write(stac_json)
 
         if args.push:
             upload_to_catalogue(stac_host, stac_filepath, overwrite=args.overwrite)
@@ -1,8 +1,27 @@
+import functools
+import os
+import re
+
+import yaml
+try:
+    # libyaml-backed loader parses the config considerably faster than the pure-Python one
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+CONFIG_FILE = "sentinel_config.yml"
+
 # imported constants, should be updated by developers
 s1_files = ["manifest.safe"]
 s2_files = ["manifest.safe"]
 s3_files = ["xfdumanifest.xml"]
 s5_files = []
+platform_files = {
+    "s1": s1_files,
+    "s2": s2_files,
+    "s3": s3_files,
+    "s5": s5_files,
+}
 product_collection_mapping = {
     r'^S1[A-DP]_.._GRD[HM]_.*': 'sentinel-1-grd',
     r'^S1[A-DP]_.._SLC__.*': 'sentinel-1-slc',
@@ -24,3 +43,48 @@ product_collection_mapping = {
     r'^S5[A-DP]_OFFL_L2_.*': 'sentinel-5p-l2',
     r'^S5[A-DP]_NRTI_L2_.*': 'sentinel-5p-l2',
 }
+
+# all collection patterns fused into one alternation, compiled once at import, so
+# mapping a product name costs a single regex match instead of one per pattern
+_collection_pattern = re.compile(
+    '|'.join(f"(?P<g{i}>{pattern})" for i, pattern in enumerate(product_collection_mapping)))
+_collection_names = list(product_collection_mapping.values())
+
+
+@functools.lru_cache(maxsize=None)
+def _load_configuration(path, mtime):
+    """
+    Parses the configuration file; cached on (path, mtime), so repeated calls within
+    one process skip both the read and the parse unless the file changed.
+    """
+    with open(path, "r") as f:
+        return yaml.load(f, Loader=YamlLoader)
+
+
+def read_configuration():
+    """
+    Read configuration file.
+    """
+    return _load_configuration(CONFIG_FILE, os.path.getmtime(CONFIG_FILE))
+
+
+def create_missing_dir(dir_path):
+    """
+    Creates directory, if it does not exist yet (including all missing directories in the path).
+    """
+    os.makedirs(dir_path, exist_ok=True)
+
+
+@functools.lru_cache(maxsize=4096)
+def _match_collection(product_prefix):
+    match = _collection_pattern.match(product_prefix)
+    return _collection_names[int(match.lastgroup[1:])] if match else None
+
+
+def map_to_collection(product_name):
+    """
+    Returns the normalized collection name for a given product, or None if no pattern matches.
+    The first 16 characters discriminate all mapped Sentinel product families, so repeated
+    products from the same family resolve via the memoized prefix lookup.
+    """
+    return _match_collection(product_name[:16])